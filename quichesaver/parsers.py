@@ -1,6 +1,12 @@
 """
 Defines functions to parse store's htmls.
 
+Each parser receives the page as raw bytes, exactly as downloaded, so that
+no decoding pass is made over pages that are searched with a regex, and the
+charset informed in the HTTP headers (or None, if there wasn't one). The
+parsers that build a tree must decode the page with it, since many pages
+don't declare their charset anywhere else.
+
 To work with the Product object, each parser must return a dictionary
 with three keys:
     - name: the product's name
@@ -12,17 +18,92 @@ to the dict "parsers" at the end of the file.
 """
 
 import re
-import json
+import codecs
+import functools
+
+import lxml.html
+import orjson
+from lxml import etree
+
+
+def _has_class(name):
+    """XPath predicate matching elements that have the class `name`."""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+# The XPath expressions are compiled once, at import time, and then reused
+# by the parsers on every call
+_SPANS = etree.XPath('//span')
+
+_BOADICA_NAME = etree.XPath(f'//div[{_has_class("nome")}]')
 
-from bs4 import BeautifulSoup
+_MAGALU_TITLE = etree.XPath(f'//h1[{_has_class("header-product__title")}]')
+_MAGALU_PRODUCT = etree.XPath(
+    f'//div[{_has_class("js-header-product")}]/@data-product')
+_MAGALU_WISHLIST = etree.XPath(
+    f'//i[{_has_class("js-wishlist")}]/@data-product')
+
+_SUBMARINO_PRICE = etree.XPath(f'//span[{_has_class("sales-price")}]')
+_NAME_DEFAULT = etree.XPath('//h1[@id="product-name-default"]')
+_NAME_STOCK = etree.XPath('//h1[@id="product-name-stock"]')
+
+_AMERICANAS_PRICE = etree.XPath('//span[contains(@class, "SalesPrice")]')
+
+# Same for the regex patterns
+_RE_BRL = re.compile(r"^R\$")
+_RE_SKUJSON = re.compile(rb'var\s+skuJson_0\s*=\s*(\{.*?\})\s*;', re.DOTALL)
+_RE_SITEMETA = re.compile(rb'var\s+siteMetadata\s*=\s*(\{.*?\})\s*;',
+                          re.DOTALL)
+
+
+# Drops the currency symbol and thousands separators, and swaps the decimal
+# comma for a dot, all in a single pass over the string
+_BRL_TABLE = str.maketrans({'R': '', '$': '', ' ': '', '.': '', ',': '.'})
+
+
+def _search_script(html, marker, pattern):
+    """
+    Search for a JS object pattern in a page, starting from its marker.
+
+    bytes.find is much faster than a regex search over the whole page, so we
+    use it to jump to where the object is declared and only match the regex
+    there. If the declaration isn't written as expected, we fall back to a
+    full search.
+    """
+    start = html.find(marker)
+    match = pattern.match(html, start) if start != -1 else None
+    return match or pattern.search(html)
+
+
+@functools.lru_cache(maxsize=32)
+def _html_parser(encoding):
+    """
+    HTML parser decoding pages with the given charset.
+
+    If the charset is unknown, the parser falls back to sniffing it from the
+    page, just like when there's no charset at all.
+    """
+    if encoding:
+        try:
+            codecs.lookup(encoding)
+            return lxml.html.HTMLParser(encoding=encoding)
+        except LookupError:
+            pass
+
+    return lxml.html.HTMLParser()
+
+
+def _html_tree(html, encoding):
+    """Build the HTML tree of a page, decoding it with the given charset."""
+    return lxml.html.fromstring(html, parser=_html_parser(encoding))
 
 
 def brl_converter(string):
     """Convert a BRL price (R$ XXX.XXX,XX) to a float."""
-    return float(string.strip("R$ ").replace('.', '').replace(',', '.'))
+    return float(string.translate(_BRL_TABLE))
 
 
-def cea_parser(html):
+def cea_parser(html, encoding=None):
     """
     Parser for cea.com.br.
 
@@ -32,14 +113,10 @@ def cea_parser(html):
 
     item = {}
 
-    # Creating the BeautifulSoup object and regex pattern
-    soup = BeautifulSoup(html, "lxml")
-    pattern = re.compile(r'var\s+skuJson_0\s*=\s*(\{.*?\})\s*;\s*')
-
-    # Get the pattern, and transform the JS object string into a dict
-    script = soup.find("script", text=pattern).string
-    item_json = pattern.search(script).group().strip('var skuJson_0 = ;')
-    item_info = json.loads(item_json)
+    # No need for a tree: search the object directly in the page and
+    # transform the JS object string into a dict
+    item_json = _search_script(html, b"var skuJson_0", _RE_SKUJSON).group(1)
+    item_info = orjson.loads(item_json)
 
     # Retrieving the item information
     item["name"] = item_info["name"]
@@ -52,7 +129,7 @@ def cea_parser(html):
     return item
 
 
-def boadica_parser(html):
+def boadica_parser(html, encoding=None):
     """
     Parser for boadica.com.br.
 
@@ -62,13 +139,13 @@ def boadica_parser(html):
 
     item = {}
 
-    # Creating the BeautifulSoup object
-    soup = BeautifulSoup(html, "lxml")
+    # Creating the HTML tree
+    tree = _html_tree(html, encoding)
 
     # Get the item name and min and max values
-    item["name"] = soup.findAll('div', {'class': 'nome'})[0].string.strip()
-    min_str, max_str = [x.text for x in
-                        soup.findAll('span', text=re.compile(r"^R\$"))]
+    item["name"] = _BOADICA_NAME(tree)[0].text_content().strip()
+    min_str, max_str = [x.text for x in _SPANS(tree)
+                        if x.text and _RE_BRL.search(x.text)]
 
     # Check if the min and max values are the same
     if min_str == "R$ 0,00" and max_str == "R$ 0,00":
@@ -81,7 +158,7 @@ def boadica_parser(html):
     return item
 
 
-def magazineluiza_parser(html):
+def magazineluiza_parser(html, encoding=None):
     """
     Parser for magazineluiza.com.br.
 
@@ -92,20 +169,18 @@ def magazineluiza_parser(html):
 
     item = {}
 
-    # Creating the BeautifulSoup object
-    soup = BeautifulSoup(html, "lxml")
+    # Creating the HTML tree
+    tree = _html_tree(html, encoding)
 
     # Checking if the class 'header-product__title' exists
-    if soup.find('h1', {'class': "header-product__title"}):
-        div_string = soup.find('div', {'class': "js-header-product"})
-        item_info = json.loads(div_string["data-product"])
+    if _MAGALU_TITLE(tree):
+        item_info = orjson.loads(str(_MAGALU_PRODUCT(tree)[0]))
 
         item["name"] = item_info["fullTitle"]
         item["available"] = True
         item["price"] = brl_converter(item_info["bestPriceTemplate"])
     else: # If it doesn't exist, the item is unavailable
-        item_json = soup.find("i", {"class": "js-wishlist"})["data-product"]
-        item_info = json.loads(item_json)
+        item_info = orjson.loads(str(_MAGALU_WISHLIST(tree)[0]))
 
         item["name"] = item_info["name"]
         item["available"] = False
@@ -114,7 +189,7 @@ def magazineluiza_parser(html):
     return item
 
 
-def submarino_parser(html):
+def submarino_parser(html, encoding=None):
     """
     Parser for submarino.com.br.
 
@@ -124,25 +199,25 @@ def submarino_parser(html):
 
     item = {}
 
-    # Creating the BeautifulSoup object
-    soup = BeautifulSoup(html, "lxml")
+    # Creating the HTML tree
+    tree = _html_tree(html, encoding)
 
     # Getting the <span> tag with the price
-    price_tag = soup.find("span", {"class": "sales-price"})
+    price_tag = _SUBMARINO_PRICE(tree)
 
     if price_tag:
-        item["name"] = soup.find("h1", id="product-name-default").string
-        item["price"] = brl_converter(price_tag.string)
+        item["name"] = _NAME_DEFAULT(tree)[0].text_content()
+        item["price"] = brl_converter(price_tag[0].text_content())
         item["available"] = True
     else:
-        item["name"] = soup.find("h1", id="product-name-stock").string
+        item["name"] = _NAME_STOCK(tree)[0].text_content()
         item["price"] = 0.0
         item["available"] = False
 
     return item
 
 
-def americanas_parser(html):
+def americanas_parser(html, encoding=None):
     """
     Parser for americanas.com.br.
 
@@ -151,18 +226,17 @@ def americanas_parser(html):
 
     item = {}
 
-    # Creating the BeautifulSoup object
-    soup = BeautifulSoup(html, "lxml")
+    # Creating the HTML tree
+    tree = _html_tree(html, encoding)
 
     # In this website, every item has a product-name-default
-    item["name"] = soup.find("h1", id="product-name-default").string
+    item["name"] = _NAME_DEFAULT(tree)[0].text_content()
 
-    # Getting the <span> tag with the price, this time with a regex
-    regex = re.compile('.*SalesPrice.*')
-    price_tag = soup.find("span", {"class": regex})
+    # Getting the <span> tag with the price, matching part of the class
+    price_tag = _AMERICANAS_PRICE(tree)
 
     if price_tag:
-        item["price"] = brl_converter(price_tag.string)
+        item["price"] = brl_converter(price_tag[0].text_content())
         item["available"] = True
     else:
         item["price"] = 0.0
@@ -171,12 +245,12 @@ def americanas_parser(html):
     return item
 
 
-def shoptime_parser(html):
+def shoptime_parser(html, encoding=None):
     """Parser for shoptime.com.br. Exactly the same as submarino.com.br."""
-    return submarino_parser(html)
+    return submarino_parser(html, encoding)
 
 
-def casasbahia_parser(html):
+def casasbahia_parser(html, encoding=None):
     """
     Parser for casasbahia.com.br.
 
@@ -185,14 +259,11 @@ def casasbahia_parser(html):
 
     item = {}
 
-    # Creating the BeautifulSoup object
-    soup = BeautifulSoup(html, "lxml")
-    pattern = re.compile(r'var\s+siteMetadata\s*=\s*(\{.*?\})\s*;\s*')
-
-    # Get the pattern, and transform the JS object string into a dict
-    script = soup.find("script", text=pattern).string
-    item_json = pattern.search(script).group().strip('var siteMetadata = ;')
-    item_info = json.loads(item_json)
+    # No need for a tree: search the object directly in the page and
+    # transform the JS object string into a dict
+    item_json = _search_script(html, b"var siteMetadata",
+                               _RE_SITEMETA).group(1)
+    item_info = orjson.loads(item_json)
 
     # Retrieving the item information
     item["name"] = item_info["page"]["name"]
@@ -1,7 +1,8 @@
 """Defining the Product class and associated functions."""
 
+import re
 import logging
-import tldextract
+import urllib.parse
 import requests
 
 from quichesaver.parsers import PARSERS
@@ -9,28 +10,96 @@ from quichesaver.parsers import PARSERS
 
 LOGGER = logging.getLogger(__name__)
 
+# A single session for every product, so that the TCP/TLS connections to
+# the stores are kept alive and reused between checks
+SESSION = requests.Session()
+SESSION.headers.update({"user-agent": "quichesaver/0.1"})
+
+# Keep a pool of connections per store, big enough to be shared by the
+# monitoring of every user
+ADAPTER = requests.adapters.HTTPAdapter(pool_connections=len(PARSERS),
+                                        pool_maxsize=20)
+SESSION.mount("https://", ADAPTER)
+SESSION.mount("http://", ADAPTER)
+
+# Everything we need is within the first megabytes of a page; the rest is
+# mostly recommendations and promotions, so we don't download it
+MAX_HTML_SIZE = 2 * 1024 * 1024
+
+
+# Stores with a parser, and thus accepted by the bot. The frozenset is for
+# membership tests, the sorted tuple for listing them to the user
+STORES = frozenset(PARSERS)
+STORES_SORTED = tuple(sorted(PARSERS))
+
+# Characters allowed in a hostname. Anything else (like a backslash, which
+# requests reads as the end of the host) could make us check one host and
+# connect to another
+_HOSTNAME_RE = re.compile(r"[a-z0-9.-]+")
+
 
 def store_domain(url):
-    """Retrieve the store domain from an URL."""
-    ext = tldextract.extract(url)
-    return '.'.join([ext.domain, ext.suffix])
+    """
+    Retrieve the store domain from an URL, if it's a supported store.
+
+    The domain is taken from the URL's host only, so userinfo or paths that
+    look like a store don't count:
+
+    >>> store_domain("https://www.cea.com.br/produto")
+    'cea.com.br'
+    >>> store_domain("http://cea.com.br:x@127.0.0.1:8080/admin") is None
+    True
+    >>> store_domain("http://evil.com\\@cea.com.br/") is None
+    True
+    """
+    try:
+        parts = urllib.parse.urlsplit(url)
+        host = parts.hostname
+    except ValueError:
+        return None
+
+    if parts.scheme not in ("http", "https") or "\\" in parts.netloc or \
+       not host or not _HOSTNAME_RE.fullmatch(host):
+        return None
+
+    # Check the host and each of its parent domains against the stores
+    labels = host.split('.')
+    for i in range(len(labels)):
+        domain = '.'.join(labels[i:])
+        if domain in STORES:
+            return domain
+
+    return None
 
 
 class Product():
     """Class for a monitored product."""
-    stores = list(PARSERS.keys())
+    __slots__ = ("url", "store", "name", "price", "available", "max_price",
+                 "unreachable_count", "_etag", "_last_modified", "_parser")
 
     def __init__(self, product_url, max_price):
         """Constructor for the Product class."""
         self.url = product_url
         self.store = store_domain(product_url)
 
+        # Validators of the last page retrieved, for conditional requests
+        self._etag = None
+        self._last_modified = None
+
+        # Nothing is known about the product before the first update
+        self.name = None
+        self.price = 0.0
+        self.available = False
+
         LOGGER.info("New product: %s at %s", self.url, self.store)
 
         # Check if the store has a corresponding parser
-        if self.store not in Product.stores:
+        if self.store not in STORES:
             raise ValueError
 
+        # The store never changes, so its parser is looked up only once
+        self._parser = PARSERS[self.store]
+
         self.update_product_info()
         self.unreachable_count = 0    # Count failures; to future implementation
         self.max_price = max_price
@@ -39,16 +108,54 @@ class Product():
 
 
     def get_html(self):
-        """Retrieve the HTML given an URL."""
-        headers = {"user-agent": "quichesaver/0.1"}
-        req = requests.get(self.url, stream=True, headers=headers)
-
-        if not (req.status_code // 100) == 2:
-            LOGGER.warning("Request for page %s returned with a status code"
-                           "different than Success.", self.url)
-            req.raise_for_status()
-
-        return req.text
+        """
+        Retrieve the HTML given an URL.
+
+        The request is conditional on the page having changed since the last
+        retrieval; if it hasn't, None is returned. Otherwise, returns the page,
+        the charset from its Content-Type header (if any), its validators
+        (ETag and Last-Modified), which must only be kept once the page was
+        parsed successfully, and whether it was truncated.
+        """
+        headers = {}
+        if self._etag:
+            headers["If-None-Match"] = self._etag
+        if self._last_modified:
+            headers["If-Modified-Since"] = self._last_modified
+
+        with SESSION.get(self.url, timeout=20, headers=headers,
+                         stream=True) as req:
+            if req.status_code == 304:
+                return None
+
+            if not (req.status_code // 100) == 2:
+                LOGGER.warning("Request for page %s returned with a status "
+                               "code different than Success.", self.url)
+                req.raise_for_status()
+
+            validators = (req.headers.get("ETag"),
+                          req.headers.get("Last-Modified"))
+
+            # requests defaults text pages to ISO-8859-1 when there's no
+            # charset; in that case, let the parser look for it in the page
+            encoding = None
+            if "charset" in req.headers.get("content-type", "").lower():
+                encoding = requests.utils.get_encoding_from_headers(
+                    req.headers)
+
+            chunks = []
+            size = 0
+            truncated = False
+            for chunk in req.iter_content(64 * 1024):
+                chunks.append(chunk)
+                size += len(chunk)
+                if size > MAX_HTML_SIZE:
+                    LOGGER.warning("Page %s is larger than %d bytes, "
+                                   "truncating it.", self.url, MAX_HTML_SIZE)
+                    truncated = True
+                    break
+
+        return b"".join(chunks), encoding, validators, truncated
 
 
     def get_product_info(self):
@@ -60,13 +167,37 @@ class Product():
 
 
     def update_product_info(self):
-        """Update the product info from the product url."""
-        html = self.get_html()
-        info = PARSERS[self.store](html)
+        """
+        Update the product info from the product url.
+
+        Returns a tuple with the previous (name, price, available) and the
+        dict with the updated info.
+        """
+        old = (self.name, self.price, self.available)
+        page = self.get_html()
+
+        # The page didn't change, so neither did the info
+        if page is None:
+            return old, self.get_product_info()
+
+        html, encoding, validators, truncated = page
+        try:
+            info = self._parser(html, encoding)
+        except Exception:
+            # Tell a page cut at MAX_HTML_SIZE apart from a broken parser
+            if truncated:
+                LOGGER.error("Could not parse page %s, truncated at %d bytes.",
+                             self.url, MAX_HTML_SIZE)
+            raise
+
+        # Only now that the page was parsed we can skip it in the next checks.
+        # A truncated page isn't the page the validators refer to, though
+        if not truncated:
+            self._etag, self._last_modified = validators
 
         self.name = info["name"]
         self.price = info["price"]
         self.available = info["available"]
         info["url"] = self.url
 
-        return info
+        return old, info
@@ -4,69 +4,144 @@ Transform floats into Decimals for better precision."""
 
 import sys
 import time
+import queue
 import threading
 import logging
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests
 
 from telegram.ext import CommandHandler, Filters, MessageHandler, Updater
 from quichesaver.conf.settings import TELEGRAM_TOKEN
-from quichesaver.product import Product
+from quichesaver.product import STORES, STORES_SORTED, Product
 
 
 LOGGER = logging.getLogger(__name__)
 
 MAX_ITEMS = 100              # Max number of items per user
 MONITOR_INTERVAL = 2 * 60    # Interval between updates, in seconds
-ITEM_INTERVAL = 2            # Interval between each individual item check.
-                             # Keep it low so that site doesn't block you
+ITEM_INTERVAL = 2            # Interval between two checks on the same store.
+                             # Keep it high so that site doesn't block you
 
+# Each store has its own queue and worker thread, shared by every user. The
+# worker makes one request at a time to its store, ITEM_INTERVAL apart, so a
+# busy store never delays the checks on the others
+STORE_QUEUES = {store: queue.Queue() for store in STORES}
 
-def monitor_items(update, context):
-    """Monitor the items informed by the user."""
+# The checks mostly wait for the stores' workers, so many of them can run at
+# once; each user has at most one check waiting or running
+CHECK_WORKERS = 32           # Number of users checked at the same time
+CHECK_EXECUTOR = ThreadPoolExecutor(max_workers=CHECK_WORKERS)
+
+
+def store_worker(store):
+    """Update the products queued for a store, one at a time."""
+    last_hit = None
     while True:
-        # Since it's possible that we modify the list, we need a lock
-        with context.user_data["lock"]:
-            matched = [False] * len(context.user_data["products"])
-
-            # Checking the price for each item
-            for i in range(len(context.user_data["products"])):
-                info_old = context.user_data["products"][i].get_product_info()
-                info = {}
-
-                # If there is a problem getting the product, just ignore it
-                # It would be best to have a timeout and drop the product
-                try:
-                    info = context.user_data["products"][i].update_product_info()
-                except Exception as exc:
-                    LOGGER.error("Error updating product: %s", exc)
-                    continue
-
-                LOGGER.info("Old info: %s; new info: %s", info_old, info)
-
-                # Informing if the product is back in stock
-                if not info_old["available"] and info["available"]:
-                    message = f"The product {info['name']} is back in stock, "\
-                              f"costing R$ {format(info['price'], '.2f')}."\
-                              f" {info['url']}"
-                    update.message.reply_text(message)
-
-                # Informing if the product is below the max price
-                if info["available"] and info["price"] <=\
-                   context.user_data["products"][i].max_price:
-                    message = f"Hey!! The item {info['name']} is now costing "\
-                              f"R$ {format(info['price'], '.2f')}! Go buy it! I "\
-                              f"will stop monitoring it. {info['url']}"
-                    update.message.reply_text(message)
-                    matched[i] = True
-
-                time.sleep(ITEM_INTERVAL)
-
-            # Removing the matched items
-            context.user_data["products"] = [elem for i, elem in \
-                enumerate(context.user_data["products"]) if not matched[i]]
-
-        # Relase the lock and wait for the next round
-        time.sleep(MONITOR_INTERVAL)
+        product, future = STORE_QUEUES[store].get()
+
+        if last_hit is not None:
+            delta = ITEM_INTERVAL - (time.monotonic() - last_hit)
+            if delta > 0:
+                time.sleep(delta)
+
+        try:
+            result = product.update_product_info()
+        except Exception as exc:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+
+        last_hit = time.monotonic()
+
+
+def start_store_workers():
+    """Start the worker thread of each store."""
+    for store in STORES:
+        threading.Thread(target=store_worker, args=(store,),
+                         name=f"worker-{store}", daemon=True).start()
+
+
+def queue_update(product):
+    """Queue a product update on its store, returning a Future for it."""
+    future = Future()
+    STORE_QUEUES[product.store].put((product, future))
+    return future
+
+
+def check_products(context):
+    """
+    Queue a check of the items informed by the user.
+
+    This is the callback of the repeating job scheduled by /start. The check
+    itself runs on CHECK_EXECUTOR, so that one user's checks don't hold the
+    job queue (or the dispatcher's workers) for everyone else.
+    """
+    user_data = context.job.context
+
+    # The lock is held from now until the check ends, so if the previous
+    # round is still waiting or running, skip this one
+    if not user_data["checking"].acquire(blocking=False):
+        LOGGER.info("Previous check still pending, skipping this one")
+        return
+
+    try:
+        CHECK_EXECUTOR.submit(run_check, user_data, context.bot)
+    except RuntimeError:
+        user_data["checking"].release()
+        raise
+
+
+def run_check(user_data, bot):
+    """Check the items informed by the user, releasing its 'checking' lock."""
+    try:
+        # Only hold the lock to take a snapshot of the list, so that the user
+        # can still add, remove and list products while they're checked
+        with user_data["lock"]:
+            products = list(user_data["products"])
+
+        matched = []
+
+        # Queueing every item at once; each store works through its own
+        futures = [queue_update(prod) for prod in products]
+
+        # Checking the price for each item
+        for prod, future in zip(products, futures):
+            # If there is a problem getting the product, just ignore it
+            # It would be best to have a timeout and drop the product
+            try:
+                (old_name, old_price, old_available), info = future.result()
+            except Exception as exc:
+                LOGGER.error("Error updating product: %s", exc)
+                continue
+
+            LOGGER.info("Old info: %s, R$ %s, available: %s; new info: %s",
+                        old_name, old_price, old_available, info)
+
+            # Informing if the product is back in stock
+            if not old_available and info["available"]:
+                message = f"The product {info['name']} is back in stock, "\
+                          f"costing R$ {info['price']:.2f}."\
+                          f" {info['url']}"
+                bot.send_message(user_data["chat_id"], message)
+
+            # Informing if the product is below the max price
+            if info["available"] and info["price"] <= prod.max_price:
+                message = f"Hey!! The item {info['name']} is now costing "\
+                          f"R$ {info['price']:.2f}! Go buy it! I "\
+                          f"will stop monitoring it. {info['url']}"
+                bot.send_message(user_data["chat_id"], message)
+                matched.append(prod)
+
+        # Removing the matched items. The list may have changed in the
+        # meantime, so we look for the products themselves, not indexes
+        if matched:
+            matched_set = set(matched)
+            with user_data["lock"]:
+                user_data["products"][:] = [
+                    prod for prod in user_data["products"]
+                    if prod not in matched_set]
+    finally:
+        user_data["checking"].release()
 
 
 def start(update, context):
@@ -78,11 +153,21 @@ def start(update, context):
     show_help(update, context)
 
     context.user_data["products"] = []
-    context.user_data["lock"] = threading.RLock()
-    context.user_data["thread"] = threading.Thread(target=monitor_items,
-                                                   args=(update, context))
-    context.user_data["thread"].start()
-    LOGGER.info("Started thread %s", context.user_data["thread"])
+
+    # If the user had already started the bot, a check may still be running,
+    # so the locks must be kept
+    context.user_data.setdefault("lock", threading.RLock())
+    context.user_data.setdefault("checking", threading.Lock())
+    context.user_data["chat_id"] = update.effective_chat.id
+
+    # If the user had already started the bot, drop the previous job
+    if "job" in context.user_data:
+        context.user_data["job"].schedule_removal()
+
+    context.user_data["job"] = context.job_queue.run_repeating(
+        check_products, interval=MONITOR_INTERVAL, first=0,
+        context=context.user_data)
+    LOGGER.info("Scheduled job %s", context.user_data["job"])
 
 
 def show_help(update, context):
@@ -93,7 +178,7 @@ def show_help(update, context):
                "  - List products and prices: /status\n"\
                "  - List commands and stores: /help\n\n"\
                "Available stores for monitoring:\n" +\
-               '\n'.join([f"  - {s}" for s in Product.stores])
+               '\n'.join([f"  - {s}" for s in STORES_SORTED])
     update.message.reply_text(response)
 
 
@@ -137,7 +222,7 @@ def add_item(update, context):
 
     response = f"Ok, I am now monitoring the product {new_prod.name} at the "\
                f"store {new_prod.store}. I'll warn you when the price drops "\
-               f"to R$ {format(new_prod.max_price, '.2f')} or less."
+               f"to R$ {new_prod.max_price:.2f} or less."
     update.message.reply_text(response)
 
 
@@ -176,7 +261,7 @@ def status(update, context):
 
         # List the items
         for i, prod in enumerate(context.user_data["products"]):
-            msg_price = f"Current price: R$ {format(prod.price, '.2f')}\n\n" if \
+            msg_price = f"Current price: R$ {prod.price:.2f}\n\n" if \
                         prod.available else "Currently unavailable\n\n"
             response = f"[ID {i + 1}] {prod.name} at {prod.store}\n" + msg_price
             update.message.reply_text(response)
@@ -199,6 +284,8 @@ def main():
     updater = Updater(token=TELEGRAM_TOKEN, use_context=True)
     disp = updater.dispatcher
 
+    start_store_workers()
+
     # Handle the commands
     disp.add_handler(CommandHandler('start', start))
     disp.add_handler(CommandHandler('ping', ping))
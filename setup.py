@@ -1,6 +1,51 @@
 # -*- coding: utf-8 -*-
 
 from setuptools import setup, find_packages
+from setuptools.command.build_ext import build_ext
+from setuptools.errors import CCompilerError, ExecError, PlatformError
+
+# The parsers run on every check, so compile them with Cython when it's
+# available. Otherwise, the pure Python module is used as is.
+try:
+    from Cython.Build import cythonize
+    from Cython.Compiler.Errors import CompileError
+except ImportError:
+    ext_modules = []
+else:
+    try:
+        ext_modules = cythonize(["quichesaver/parsers.py"],
+                                compiler_directives={"language_level": 3})
+    except CompileError as exc:
+        print(f"Could not cythonize the parsers ({exc}); using the pure "
+              "Python module instead.")
+        ext_modules = []
+
+
+class OptionalBuildExt(build_ext):
+    """Build the extensions, falling back to pure Python if it fails."""
+
+    def run(self):
+        try:
+            super().run()
+        except PlatformError as exc:
+            print(f"Could not build the extensions ({exc}); using the pure "
+                  "Python modules instead.")
+
+    def build_extensions(self):
+        self.failed = []
+        super().build_extensions()
+
+        # The extensions that failed must not be copied or installed
+        self.extensions = [ext for ext in self.extensions
+                           if ext.name not in self.failed]
+
+    def build_extension(self, ext):
+        try:
+            super().build_extension(ext)
+        except (CCompilerError, ExecError, PlatformError) as exc:
+            print(f"Could not build {ext.name} ({exc}); using the pure "
+                  "Python module instead.")
+            self.failed.append(ext.name)
 
 
 with open('README.md') as f:
@@ -18,5 +63,7 @@ setup(
     author_email='matheus.moreno@poli.ufrj.br',
     url='https://github.com/matheusMoreno/quichesaver',
     license=license,
-    packages=find_packages(exclude=())
+    packages=find_packages(exclude=()),
+    ext_modules=ext_modules,
+    cmdclass={"build_ext": OptionalBuildExt}
 )